@@ -1,12 +1,58 @@
 import spotipy.util as util
+import concurrent.futures
+import functools
+import operator
+import os
 import requests
 import spotipy
 import pprint
+import re
+import shelve
 import sys
 import numpy as np
 
+try:
+    from scipy.spatial import cKDTree
+    from scipy.spatial.distance import cdist
+except ImportError:
+    cKDTree = None
 
-def create_new_playlist(sp, username, name, tracklist, playlist_size):
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Audio features used to compare tracks, in the order they are stored.
+FEATURE_FILTER = ('danceability', 'energy', 'instrumentalness', 'loudness', 'speechiness', 'tempo', 'valence')
+_GET_FEATURES = operator.itemgetter(*FEATURE_FILTER)
+
+LASTFM_URL = "http://ws.audioscrobbler.com/2.0/"
+
+# Genres found on earlier runs, keyed by artist and track name.
+GENRE_CACHE_PATH = os.path.expanduser('~/.cache/spotiflow/genres.db')
+
+# Most Last.fm requests allowed in flight at once.
+LASTFM_MAX_WORKERS = 10
+
+# Genres a track can be tagged with, matched longest first.
+GENRES_LIST = ['electronic', 'jazz', 'hip hop', 'pop', 'rock',
+               'alternative rock', 'metal', 'indie']
+_GENRE_RE = re.compile('|'.join(map(re.escape, sorted(GENRES_LIST, key=len, reverse=True))), re.I)
+
+# Shared session so Last.fm requests reuse pooled keep-alive connections.
+_SESSION = requests.Session()
+_SESSION.headers['Accept-Encoding'] = 'gzip'
+
+# Playlists at least this long are ordered without a dense distance
+# matrix, using a KD-tree or a JIT-compiled scan when available.
+KDTREE_MIN_TRACKS = 256
+
+# Most neighbors queried from the KD-tree before scanning every unvisited
+# track instead.
+KDTREE_MAX_NEIGHBORS = 64
+
+
+def create_new_playlist(sp, username, name, tracklist):
     """
     Creates a new playlist from a tracklist.
 
@@ -14,28 +60,14 @@ def create_new_playlist(sp, username, name, tracklist, playlist_size):
     :param username: Spotify username.
     :param name: Name of the playlist name to be created.
     :param tracklist: List of track ids to be added to the playlist.
-    :param playlist_size: The size of the playlist that is being created.
     """
 
     # Create empty playlist.
-    sp.user_playlist_create(username, name, True)
-
-    # Get user's playlists.
-    playlists_result = sp.user_playlists(username)
-    new_playlist_id = None
-
-    # Look for new playlist.
-    for playlist in playlists_result['items']:
-        if playlist['name'] == name:
-            new_playlist_id = playlist['id']
-
-    # Iterate over offset of playlist by track_size 100 to meet rate limit.
-    for i in range((playlist_size // 100) + 1):
-        sub_tracks = tracklist[(100 * i):(i * 100 + 100)]
+    new_playlist = sp.user_playlist_create(username, name, True)
 
-        # Add tracks to new playlist.
-        if new_playlist_id is not None and len(sub_tracks) > 0:
-            sp.user_playlist_add_tracks(username, new_playlist_id, sub_tracks)
+    # Add tracks to new playlist, 100 at a time to meet the API limit.
+    for i in range(0, len(tracklist), 100):
+        sp.user_playlist_add_tracks(username, new_playlist['id'], tracklist[i:i + 100])
 
     print(name, " created!\n")
 
@@ -49,52 +81,198 @@ def order_tracks(playlist, track_features):
     :return: (list) A list of track_ids ordered by closeness.
     """
 
-    # Solution and remaining lists.
-    remaining = playlist.copy()
-    solution = []
+    # Stack the features of every track into a single (N, 7) array.
+    ids = list(playlist)
+    if not ids:
+        return []
+    features = np.asarray([track_features[track] for track in ids], dtype=np.float32)
+
+    # Small playlists get a dense nearest neighbor tour refined with 2-opt.
+    # Large ones use a KD-tree with SciPy, or a JIT-compiled scan with
+    # Numba.
+    if len(ids) < KDTREE_MIN_TRACKS:
+        sq_distances = get_sq_distance_matrix(features)
+        order = two_opt(dense_tour(sq_distances), np.sqrt(sq_distances))
+    elif cKDTree is not None:
+        order = kdtree_tour(features)
+    elif njit is not None:
+        order = nn_tour(features).tolist()
+    else:
+        order = dense_tour(get_sq_distance_matrix(features))
+
+    return [ids[i] for i in order]
+
+
+def dense_tour(sq_distances):
+    """
+    Returns a nearest neighbor visiting order using a dense distance matrix.
+
+    :param sq_distances: (N, N) array of squared pairwise track distances.
+    :return: (list) Indices of the tracks in visiting order.
+    """
+    visited = np.zeros(len(sq_distances), dtype=bool)
 
-    # Get starting track, add it to the solution, and remove it
-    # from remaining tracks.
-    current = list(remaining.keys())[0]
-    del remaining[current]
-    solution.append(current)
+    # Start from the first track.
+    current = 0
+    visited[current] = True
+    order = [current]
 
     # Iterate through the remaining elements.
-    for i in range(len(remaining)):
-        min_distance = -1
-        min_track = None
-
-        # Find the min track
-        for track in remaining:
-            distance = get_distance(np.array(track_features[current]),
-                                    np.array(track_features[track]))
-            if min_distance == -1 or min_distance > distance:
+    for i in range(len(sq_distances) - 1):
+        # Find the closest track that has not been visited yet.
+        current = int(np.argmin(np.where(visited, np.inf, sq_distances[current])))
+
+        # Update current and add to the solution.
+        visited[current] = True
+        order.append(current)
+
+    return order
+
+
+def kdtree_tour(features):
+    """
+    Returns a nearest neighbor visiting order using a KD-tree.
+
+    :param features: (N, 7) array of track features.
+    :return: (list) Indices of the tracks in visiting order.
+    """
+    tree = cKDTree(features)
+    visited = np.zeros(len(features), dtype=bool)
+
+    # Start from the first track.
+    current = 0
+    visited[current] = True
+    order = [current]
+
+    # Iterate through the remaining elements.
+    for i in range(len(features) - 1):
+        # Query more neighbors until one of them has not been visited yet.
+        # Once the nearby tracks are all visited, compute the distances to
+        # the unvisited tracks one row at a time instead.
+        k = 2
+        while k <= KDTREE_MAX_NEIGHBORS:
+            neighbors = tree.query(features[current], k=min(k, len(features)))[1]
+            unvisited = neighbors[~visited[neighbors]]
+            if len(unvisited) > 0:
+                current = int(unvisited[0])
+                break
+            k *= 2
+        else:
+            active_idx = np.flatnonzero(~visited)
+            sq_distances = cdist(features[current][None], features[active_idx], metric='sqeuclidean')[0]
+            current = int(active_idx[sq_distances.argmin()])
+
+        # Update current and add to the solution.
+        visited[current] = True
+        order.append(current)
+
+    return order
+
+
+def sq_distance7(a, b):
+    """
+    Returns the squared euclidean distance between two 7 feature tracks.
+    """
+    s = 0.0
+    for k in range(7):
+        t = a[k] - b[k]
+        s += t * t
+    return s
+
+
+if njit is not None:
+    sq_distance7 = njit(fastmath=True)(sq_distance7)
+
+
+def nn_tour(features):
+    """
+    Returns a nearest neighbor visiting order by scanning squared distances
+    in plain loops. Compiled with Numba when it is installed.
+
+    :param features: (N, 7) array of track features.
+    :return: (np.ndarray) Indices of the tracks in visiting order.
+    """
+    n = features.shape[0]
+    visited = np.zeros(n, dtype=np.bool_)
+    order = np.empty(n, dtype=np.int64)
+
+    # Start from the first track.
+    current = 0
+    visited[current] = True
+    order[0] = current
+
+    for step in range(1, n):
+        # Find the closest track that has not been visited yet.
+        min_track = -1
+        min_distance = np.inf
+        for track in range(n):
+            if visited[track]:
+                continue
+            distance = sq_distance7(features[current], features[track])
+            if distance < min_distance:
                 min_distance = distance
                 min_track = track
 
-        # Update current, add to solutions, and remove from remaining.
+        # Update current and add to the solution.
         current = min_track
-        solution.append(current)
-        del remaining[current]
+        visited[current] = True
+        order[step] = current
+
+    return order
 
-    return solution
 
+if njit is not None:
+    nn_tour = njit(cache=True)(nn_tour)
 
-def get_distance(a, b):
+
+def two_opt(order, distances):
     """
-    Returns the euclidean distance between two track features lists.
+    Shortens a visiting order by reversing segments of it (2-opt) until no
+    reversal makes it shorter. The first track stays first.
+
+    :param order: (list) Indices of the tracks in visiting order.
+    :param distances: (N, N) array of pairwise track distances.
+    :return: (list) Indices of the tracks in the improved visiting order.
     """
-    return np.linalg.norm(a - b)
+    n = len(order)
+    if n < 3:
+        return order
+
+    # Append a dummy track at zero distance from every track, so the
+    # last track of the order can be moved freely.
+    padded = np.zeros((n + 1, n + 1), dtype=distances.dtype)
+    padded[:n, :n] = distances
+    tour = np.append(order, n)
+
+    # Every segment tour[i..j] that can be reversed, 1 <= i < j < n.
+    i, j = np.triu_indices(n, k=1)
+    keep = i >= 1
+    i, j = i[keep], j[keep]
 
+    while True:
+        # Change in length from reversing each segment.
+        delta = (padded[tour[i - 1], tour[j]] + padded[tour[i], tour[j + 1]]
+                 - padded[tour[i - 1], tour[i]] - padded[tour[j], tour[j + 1]])
+        best = int(np.argmin(delta))
+        if delta[best] > -1e-6:
+            break
 
-def remove_query_spaces(q):
+        tour[i[best]:j[best] + 1] = tour[i[best]:j[best] + 1][::-1]
+
+    return tour[:n].tolist()
+
+
+def get_sq_distance_matrix(features):
     """
-    Replaces spaces with + in a query.
+    Returns the squared euclidean distances between every pair of track
+    features. Nearest neighbor comparisons need no square root.
 
-    :param q: Query such as an artist or track name.
-    :return: The query with + in place of spaces.
+    :param features: (N, 7) array of track features.
+    :return: (N, N) array of squared pairwise distances.
     """
-    return '+'.join(q.split(' '))
+    gram = features @ features.T
+    sq_norms = np.einsum('ij,ij->i', features, features)
+    return np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2 * gram, 0)
 
 
 def get_genres(track, artist, keys):
@@ -106,58 +284,103 @@ def get_genres(track, artist, keys):
     :param keys: API keys for Last.fm API.
     :return: (str) the genre of the track if available.
     """
-    genres_list = ['electronic', 'jazz', 'hip hop', 'pop', 'rock',
-                   'alternative rock', 'metal', 'indie']
+    return _fetch_genre(artist, track, keys[2].rstrip())
 
-    # Format artist and track name and create url from them
-    artist = remove_query_spaces(artist)
-    track = remove_query_spaces(track)
-    url = "http://ws.audioscrobbler.com/2.0/?method=track.getInfo&api_key=" \
-          + keys[2] + "&artist=" + artist + "&track=" + track + "&format=json"
 
-    # Last.fm GET request and parsed to json.
-    response = requests.get(url).json()
+@functools.lru_cache(maxsize=4096)
+def _fetch_genre(artist, track, api_key):
+    """
+    Fetches the genre of a track from the Last.fm API. Results are memoized,
+    so repeated lookups of the same track make no request.
 
-    # Find all Last.fm tags for the song.
-    tags = []
+    :param artist: Artist name.
+    :param track: Track name.
+    :param api_key: Last.fm API key.
+    :return: (str) the genre of the track if available.
+    """
+    # Last.fm GET request and parsed to json. requests encodes the
+    # artist and track name in the query string.
+    params = {'method': 'track.getInfo', 'api_key': api_key, 'artist': artist,
+              'track': track, 'format': 'json'}
+    response = _SESSION.get(LASTFM_URL, params=params, timeout=5).json()
+
+    # Returns the first genre that is matched by a Last.fm tag for the
+    # song.
     if 'track' in response:
         for tag in response['track']['toptags']['tag']:
-            tags.append(tag['name'])
-
-    # Returns the first genre that is matched by a tag and the genre
-    # filter.
-    for tag in tags:
-        for genre in genres_list:
-            if tag.lower() in genre or genre in tag.lower():
-                return genre
+            match = _GENRE_RE.search(tag['name'])
+            if match:
+                return match.group(0).lower()
 
     return None
 
 
-def get_track_features(track_id, sp):
+def get_all_genres(playlist, keys):
     """
-    Returns the features of a given track if features for the track exist.
+    Returns the genres of all tracks in a playlist. Genres cached on disk by
+    earlier runs are reused and the rest are fetched concurrently.
+
+    :param playlist: Dictionary of track ids mapped to track and artist names.
+    :param keys: API keys for Last.fm API.
+    :return: (dict) Track ids mapped to their genre, or None if not found.
+    """
+    os.makedirs(os.path.dirname(GENRE_CACHE_PATH), exist_ok=True)
+
+    with shelve.open(GENRE_CACHE_PATH) as cache:
+        # Fetch each track missing from the cache once.
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(LASTFM_MAX_WORKERS) as executor:
+            for name, artist in playlist.values():
+                key = artist + '\t' + name
+                if key not in cache and key not in futures:
+                    futures[key] = executor.submit(get_genres, name, artist, keys)
 
-    :param track_id: The spotify id of the track.
+        # Only found genres are cached, so a failed lookup is retried on the
+        # next run.
+        for key, future in futures.items():
+            if future.result() is not None:
+                cache[key] = future.result()
+
+        track_genres = {}
+        for track_id, (name, artist) in playlist.items():
+            key = artist + '\t' + name
+            track_genres[track_id] = futures[key].result() if key in futures else cache[key]
+
+    return track_genres
+
+
+def get_track_features(track_ids, sp):
+    """
+    Returns the features of the given tracks for which features exist.
+
+    :param track_ids: The spotify ids of the tracks.
     :param sp: Spotify auth object.
-    :return: (list) Track feature names mapped to their values.
+    :return: (dict) Track ids mapped to their array of feature values.
     """
 
-    feature_filter = ['danceability', 'energy', 'instrumentalness', 'loudness', 'speechiness', 'tempo', 'valence']
-    return_features = []
+    track_features = {}
 
-    # Get features from this track.
-    features = sp.audio_features([track_id])
+    # Get features 100 tracks at a time, the most the endpoint accepts.
+    for i in range(0, len(track_ids), 100):
+        sub_ids = track_ids[i:i + 100]
+        rows = [_GET_FEATURES(row) if row else None for row in sp.audio_features(sub_ids)]
 
-    if None in features:
-        return []
+        # Add desired features of each track that has them.
+        found_ids = [track_id for track_id, row in zip(sub_ids, rows) if row is not None]
+        if not found_ids:
+            continue
+        values = np.asarray([row for row in rows if row is not None], dtype=np.float32)
+
+        # Scale loudness (-60 to 0 dB) and tempo (BPM) to about [0, 1] like
+        # the other features.
+        loudness = FEATURE_FILTER.index('loudness')
+        tempo = FEATURE_FILTER.index('tempo')
+        values[:, loudness] = (values[:, loudness] + 60) / 60
+        values[:, tempo] /= 250
 
-    # Add desired features of track.
-    for feature in features[0]:
-        if feature in feature_filter:
-            return_features.append(features[0][feature])
+        track_features.update(zip(found_ids, values))
 
-    return return_features
+    return track_features
 
 
 def pick_playlist(sp, username):
@@ -247,7 +470,6 @@ def main():
     if token:
         sp = spotipy.Spotify(auth=token)
         playlist = {}
-        track_features = {}
         track_genre = {}
 
         # Prompt user for playlist selection.
@@ -255,18 +477,18 @@ def main():
         playlist_name = playlist_id[0]
         playlist_id = playlist_id[1]
 
-        # Get tracks from the playlist, 100 at a time to meet rate limit.
+        # Get tracks from the playlist, following pages of 100 until the
+        # last one. Only the fields used below are requested.
         playlist_result = []
-        for i in range((playlist_size // 100) + 1):
-            # Get playlist information from id.
-            temp_result = sp.user_playlist_tracks(playlist_owner_id, playlist_id=playlist_id, offset=i)
-            temp_result = temp_result['items']
-            playlist_result = playlist_result + temp_result
-        playlist_result = playlist_result[:playlist_size]
+        results = sp.user_playlist_tracks(playlist_owner_id, playlist_id=playlist_id,
+                                          fields='items(track(id,name,artists(name))),next', limit=100)
+        while results:
+            playlist_result.extend(results['items'])
+            results = sp.next(results)
 
         print("Gathering features and genre...")
 
-        # Add tracks to playlist dictionary and get features
+        # Add tracks to playlist dictionary.
         for track in playlist_result:
             # Gather the track and artist name, and track id for each track.
             track_id = track['track']['id']
@@ -276,17 +498,17 @@ def main():
             # Add track to this playlist.
             playlist[track_id] = [name, artist]
 
-            # Gather features for this track.
-            track_features[track_id] = get_track_features(track_id, sp)
+        # Gather features for all tracks at once.
+        track_features = get_track_features(list(playlist), sp)
 
-            # Get the genre of the track.
-            # track_genre[track_id] = get_genres(name, artist, keys)
+        # Get the genres of all tracks.
+        # track_genre = get_all_genres(playlist, keys)
 
         print("Done\n")
 
-        # Clean track features of empty features.
-        for track in track_features:
-            if track_features[track] is None:
+        # Clean playlist of tracks without features.
+        for track in list(playlist):
+            if track not in track_features:
                 del playlist[track]
         print(len(track_features))
 
@@ -299,7 +521,7 @@ def main():
 
         # Create playlist from new tracklist.
         if should_create.lower() != "n" and should_create.lower() != "no":
-            create_new_playlist(sp, username, new_playlist_name, new_tracklist, playlist_size)
+            create_new_playlist(sp, username, new_playlist_name, new_tracklist)
 
         print("Thanks for using Spotiflow!")
 